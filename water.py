@@ -20,14 +20,30 @@
 import sys
 import getopt
 import os.path
-import sqlite3
+import codecs
+import re
 import time
 import subprocess
-from collections import namedtuple
+from collections import Counter
 import csv
 import datetime
 from multiprocessing import Pool
 
+# Matches the lines of the git log we care about: a commit header, which
+# starts with a record separator, the start of a file's diff, the start of a
+# hunk, the name of the file a patch applies to, the old and new names of a
+# renamed file, or a line added by a patch. Lines inside a hunk always start
+# with a space, + or -, so none of them can be mistaken for the others,
+# except that an added line starting with ++ looks like a +++ line.
+
+log_line_pattern = re.compile(rb'^(?:\x1e(.*)|(diff --git ).*|(@@ ).*|\+\+\+ (.*)|'
+	rb'rename from (.*)|rename to (.*)|\+(.*))$', re.MULTILINE)
+
+# The fields in each commit header, in the order they're written to the CSV
+
+commit_fields = ('author_name','author_email','author_date',
+	'committer_name','committer_email','committer_date','commit_hash')
+
 #### Helper functions ####
 
 def print_usage():
@@ -40,10 +56,12 @@ def print_usage():
 		"File filtering:\n"
 		"  Water attempts to ignore files which will likely bias the output, such as binaries and\n"
 		"  eps files.  You can disable this, but it's probably a really bad idea.\n\n"
-		"  Ignored files and extensions: %s\n\n"
+		"  Ignored files and extensions: %s\n"
+		"  Files with a NUL byte in their first 8000 bytes are also treated as binaries.\n\n"
 		"Optional analysis arguments:\n"
 		"    -m           Disable multithreading (implied by -v and -V)\n"
-		"    -i           Disable the ignored files list, even though they'll probably not be matched properly\n"
+		"    -i           Disable the ignored files list and binary detection, even though they'll probably\n"
+		"                  not be matched properly\n"
 		"                  THIS OPTION CAN GIVE YOU GARBAGE DATA IF YOU AREN'T CAREFUL\n"
 		"    -S <number>  Adjusts sensitivity. Lines shorter than <number> are not considered for matching.\n"
 		"                  Whitespace lines are always ignored.\n\n"
@@ -69,245 +87,313 @@ def print_usage():
 		"    water.csv    A CSV file in your working directory with the analysis results.\n\n"
 		% str(ignore_files_list)[1:-1])
 
-def analyze_file(root,filenames):
+def read_lines_in_blocks(stream,block_size=1<<20):
 
-# This is the core of the analysis, which allows us to use multiprocessing
+# Read a stream in large blocks, each ending on a line boundary
 
-	if verbose:
-		global file_count
+	remainder = b''
 
-	for filename in filenames:
+	while True:
 
-		# If we're in a .git directory, move on to the next directory
+		block = stream.read(block_size)
 
-		if root.startswith(os.path.join(source,'.git')):
+		if not block:
+			if remainder:
+				yield remainder
+			return
 
-			if verbose:
-				print(' Ignoring %s file(s) from %s: .git directory' % (len(filenames),root))
-				file_count += 1
+		block = remainder + block
+		end = block.rfind(b'\n') + 1
+		remainder = block[end:]
 
-			break
+		if end:
+			yield block[:end]
 
-		# If the file has an ignored extension, move on to the next file
+def decode_git_path(path):
 
-		if ignore_files and filename.endswith(ignore_files_list):
+# Turn a path from a patch header into a str, undoing git's quoting of paths
+# with unusual characters. Paths containing spaces get a trailing tab.
 
-			if verbose:
-				print(' Ignoring file %s (%s of %s): On the ignored files list' %
-					(filename,file_count,total_files))
-				file_count += 1
-
-			continue
+	path = path.rstrip(b'\t')
 
-		# Set up the in-memory database
+	if path.startswith(b'"'):
+		path = codecs.escape_decode(path[1:-1])[0]
 
-		db_conn = sqlite3.connect(':memory:')
-		cursor = db_conn.cursor()
+	return os.fsdecode(path)
 
-		cursor.execute('''CREATE TABLE data (filename TEXT,
-		author_name TEXT, author_email TEXT, author_date TEXT,
-		committer_name TEXT, committer_email TEXT, committer_date TEXT,
-		commit_hash TEXT, number_lines INTEGER,
-		unique(filename, author_name, author_email, author_date,
-		committer_name, committer_email, committer_date, commit_hash)
-		ON CONFLICT IGNORE)''')
+def read_log_index(git_paths):
 
-		# Get all the commits related to the current file
+# Read the history of the whole repo with a single git log, and index the
+# lines added to each of the files in git_paths by their text. Renames are
+# followed back through history, so lines added under an older name count
+# toward the name the file has now. Also returns the set of line lengths in
+# each file's index, so lines that can't match are rejected cheaply.
 
-		current_file = os.path.join(root,filename)
+	# Each commit's header is one line, starting with a record separator and
+	# with its fields split by NULs, so it can't be mistaken for a line of the
+	# patch and no field value can be confused with a separator. The a/ and b/
+	# prefixes are set explicitly, as diff.noprefix would otherwise drop them.
+	# Paths are relative to the repo path we were given, which may be a
+	# subdirectory of the repo, just as the paths in the snapshot are.
 
-		if verbose:
-			print('\n Analyzing file (%s of %s): %s' % (file_count,total_files,current_file))
-			file_count += 1
+	git_log_command = ['git','-C',repo,'-c','core.quotePath=false',
+		'log','-p','-M','--relative','--src-prefix=a/','--dst-prefix=b/','--date=short',
+		'--pretty=format:%x1e%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd%x00%H']
 
-		git_log_command = ("git -C %s log --follow -p -M "
-			"--pretty=format:'"
-			"hash: %%H%%n"
-			"author_name: %%an%%nauthor_email: %%ae%%nauthor_date:%%ai%%n"
-			"committer_name: %%cn%%ncommitter_email: %%ce%%ncommitter_date: %%ci%%n"
-			"EndPatch' -- %s"
-			% (repo,current_file[len(source):]))
+	log_index = dict()
 
-		git_log_raw = subprocess.Popen([git_log_command], stdout=subprocess.PIPE, shell=True)
+	# The newer name of each file that was renamed, as of the point we've
+	# reached walking backwards through history
 
-		git_log = list()
+	renamed = dict()
+	rename_from = None
 
-		patchline = namedtuple('patchline','commit_hash author_name author_email author_date '
-			'committer_name committer_email committer_date '
-			'linetext')
+	# Set some defaults, just in case
 
-		# Set some defaults, just in case
+	commit = ('(Unknown)',) * len(commit_fields)
+	file_log_index = None
+	in_diff_header = False
 
-		author_name = author_email = author_date = '(Unknown)'
-		committer_name = committer_email = committer_date = '(Unknown)'
+	# Settings used for every line of the log are looked up once, as locals.
+	# Empty lines are never kept, whatever the sensitivity.
 
-		linetext = ''
+	min_length = max(sensitivity,1)
+	show_lines = obnoxious
 
-		# Walk through the file's log and store history data
+	# Walk through the log and store history data. The log is read in blocks
+	# as it is produced and kept as bytes, and each block is scanned for the
+	# lines we need in a single pass of the regex.
 
-		if obnoxious:
-			print('\n   Walking through the git log:')
+	if obnoxious:
+		print('\n   Walking through the git log:')
 
-		for line in git_log_raw.stdout.read().decode("utf-8", errors='ignore').split(os.linesep):
+	# Leaving the with block closes the pipe and waits for git to exit, even
+	# if parsing stops early
 
-			if len(line) > 0:
+	with subprocess.Popen(git_log_command, stdout=subprocess.PIPE,
+		bufsize=1<<20) as git_log_raw:
 
-				# Bypass lines we don't need.
+		for block in read_lines_in_blocks(git_log_raw.stdout):
 
-				if (line.find('diff --git ') == 0 or
-					line.find('index ') == 0 or
-					line.find('+++ ') == 0 or
-					line.find('--- ') == 0 or
-					line.find('@@ -') == 0 or
-					line.find('rename to ') == 0 or
-					line.find('parents: ') == 0 or
-					line.find('    ') == 0):
-					continue
+			for (fields, diff_start, hunk_start, patched_path, old_path, new_path,
+				addition) in log_line_pattern.findall(block):
 
 				# Match header lines
 
-				if line.find('hash: ') == 0:
-					commit_hash = line[6:]
-					if obnoxious:
-						print('    commit_hash: %s' % commit_hash)
+				if fields:
+
+					commit = tuple(field.decode('utf-8', errors='ignore')
+						for field in fields.split(b'\x00'))
+
+					file_log_index = None
+					in_diff_header = False
+
+					if show_lines:
+						for field, value in zip(commit_fields,commit):
+							print('    %s: %s' % (field,value))
 
-				if line.find('author_name:') == 0:
-					author_name = line[13:].replace("'","\\'")
-					if obnoxious:
-						print('    author_name: %s' % author_name)
 					continue
 
-				if line.find('author_email:') == 0:
-					author_email = line[14:].replace("'","\\'")
-					if obnoxious:
-						print('    author_email: %s' % author_email)
+				# A +++ line only names the patched file between the start of
+				# a file's diff and its first hunk
+
+				if diff_start:
+					in_diff_header = True
 					continue
 
-				if line.find('author_date:') == 0:
-					author_date = line[12:22]
-					if obnoxious:
-						print('    author_date: %s' % author_date)
+				if hunk_start:
+					in_diff_header = False
 					continue
 
-				if line.find('committer_name:') == 0:
-					committer_name = line[16:].replace("'","\\'")
-					if obnoxious:
-						print('    committer_name: %s' % committer_name)
+				# Find which file the following lines were added to, under the
+				# name it has now. Deleted files are patched to /dev/null.
+
+				if patched_path and in_diff_header:
+
+					patched_path = decode_git_path(patched_path)[2:]
+					patched_path = renamed.get(patched_path,patched_path)
+
+					if patched_path in git_paths:
+						file_log_index = log_index.setdefault(patched_path,dict())
+					else:
+						file_log_index = None
+
 					continue
 
-				if line.find('committer_email:') == 0:
-					committer_email = line[17:].replace("'","\\'")
-					if obnoxious:
-						print('    committer_email: %s' % committer_email)
+				if old_path:
+					rename_from = decode_git_path(old_path)
 					continue
 
-				if line.find('committer_date:') == 0:
-					committer_date = line[16:26]
-					if obnoxious:
-						print('    committer_date: %s' % committer_date)
+				if new_path:
+					new_path = decode_git_path(new_path)
+					renamed[rename_from] = renamed.get(new_path,new_path)
 					continue
 
 				# Store additions for comparison. Ignore removals because we
-				# are only finding the last person to modify the line (for now)
+				# are only finding the last person to modify the line (for now).
+				# Lines too short to ever be matched aren't worth keeping.
 
-				if line.find('+') == 0 and len(line[1:].strip()) > 0:
-					if obnoxious:
-						print('    patch line: %s' % line[1:].strip())
-
-					git_log.append(patchline(commit_hash,author_name,author_email,author_date,
-						committer_name,committer_email,committer_date,
-						line[1:].strip()))
+				if file_log_index is None:
 					continue
 
-		# Now reverse the git log so we search in reverse chronological order to
-		# find the first occurance of the intact line. This handles situations
-		# where files were deleted and created, and is necessary because
-		# git log --follow --reverse <file> doesn't seem to follow renames.
+				# Inside a hunk, a +++ line is an added line starting with ++
 
-		git_log.reverse()
+				if patched_path:
+					addition = b'++ ' + patched_path
 
-		# Now walk through the file and look for matches in the git log
+				linetext = addition.strip()
 
-		if obnoxious:
-			print('\n   Walking through the file:')
+				if len(linetext) >= min_length:
+					if show_lines:
+						print('    patch line: %s' % linetext.decode('utf-8', errors='ignore'))
 
-		# We have to open in rb because we may encounter binaries
+					# The log runs from newest to oldest, so overwriting leaves
+					# the first commit to add an intact copy of the line. This
+					# handles situations where files were deleted and created.
 
-		snapshot_file = open(current_file,'rb')
+					file_log_index[linetext] = commit
 
-		matched = 0 # can probably lose this, it'll be in the database
-		unmatched = 0
+	# Worked out once per file here, rather than each time the file is matched
 
-		for fileline in snapshot_file:
+	line_lengths = dict((path, frozenset(len(linetext) for linetext in file_log_index))
+		for path, file_log_index in log_index.items())
 
-			match_found = 0
+	return (log_index,line_lengths)
 
-			if len(fileline.strip()) < sensitivity:
-				continue
+def match_lines(filelines,file_log_index,line_lengths):
+
+# Look up each stripped line of a file in the log index, and count the matched
+# lines per commit. This is the innermost loop of the analysis, and is kept
+# small so it's easy for pypy3 to compile.
+
+	matches = Counter()
+	unmatched = 0
+
+	# Settings used for every line are looked up once, as locals
+
+	show_lines = obnoxious
+
+	for fileline in filelines:
+
+		if show_lines:
+			print('    File line: %s' % fileline)
+
+		# A line can only match if something in the log has the same length,
+		# and checking that is cheaper than hashing a line never committed
+
+		if len(fileline) in line_lengths:
+			commit = file_log_index.get(fileline)
+		else:
+			commit = None
+
+		if commit is not None:
+
+			if show_lines:
+				print('    * Matched: %s\n' % fileline.decode('utf-8', errors='ignore'))
+
+			matches[commit] += 1
+
+		else:
+			unmatched += 1
+
+	return (matches,unmatched)
+
+def init_worker(settings):
+
+# Give a pool worker the options set in the parent. With the fork start
+# method workers would inherit these anyway, but with spawn (the default on
+# macOS and Windows) they start from a fresh import of this file and none of
+# the settings from __main__ exist.
+
+	globals().update(settings)
+
+def analyze_file(task):
+
+# This is the core of the analysis, which allows us to use multiprocessing.
+# Each task is a file, the part of the log index that belongs to it, and the
+# lengths of the lines in that part.
+
+	current_file, file_log_index, line_lengths = task
+
+	if verbose:
+		global file_count
+
+	# Get all the commits related to the current file
+
+	if verbose:
+		print('\n Analyzing file (%s of %s): %s' % (file_count,total_files,current_file))
+		file_count += 1
+
+	# We have to open in rb because we may encounter binaries. Unless the
+	# ignored files list is disabled, a NUL byte near the start of the file
+	# marks it as binary (the same test git uses) and it is skipped before
+	# we go to the trouble of reading its history. Otherwise the whole file
+	# is read in one go, to be split into lines later.
 
-			if obnoxious:
-				print('    File line: %s' % fileline.strip())
-
-			for git_log_line in git_log:
-
-				if git_log_line.linetext.encode() == fileline.strip():
-
-					if obnoxious:
-						print('    * Matched: %s\n' % git_log_line.linetext)
-					matched += 1
-					match_found = 1
-
-					# Brute forcification since sqlite has no 'ON DUPLICATE UPDATE'
-
-					cursor.execute('''INSERT OR IGNORE INTO data (filename,
-						author_name, author_email, author_date,
-						committer_name, committer_email, committer_date,
-						commit_hash, number_lines)
-						VALUES (?,?,?,?,?,?,?,?,0)''',
-						(current_file,
-						git_log_line.author_name, git_log_line.author_email, git_log_line.author_date,
-						git_log_line.committer_name, git_log_line.committer_email, git_log_line.committer_date,
-						git_log_line.commit_hash))
-
-					cursor.execute('''UPDATE data SET number_lines =
-						number_lines+1 WHERE filename = ? AND
-						author_name = ? AND author_email = ? AND author_date = ? AND
-						committer_name = ? AND committer_email = ? AND committer_date = ? AND
-						commit_hash = ?''',
-						(current_file,
-						git_log_line.author_name, git_log_line.author_email, git_log_line.author_date,
-						git_log_line.committer_name, git_log_line.committer_email, git_log_line.committer_date,
-						git_log_line.commit_hash))
-
-					break
-
-			if not match_found:
-				unmatched += 1
-
-		if unmatched:
-			cursor.execute(''' INSERT INTO data (filename,
-				author_name, author_email, author_date,
-				committer_name, committer_email, committer_date,
-				commit_hash, number_lines)
-				VALUES (?,
-				'Unmatched','Unmatched','Unmatched',
-				'Unmatched','Unmatched','Unmatched',
-				'N/A',?)''', (current_file,unmatched))
+	with open(current_file,'rb') as snapshot_file:
+
+		snapshot = snapshot_file.read(8000)
+
+		if ignore_files and b'\x00' in snapshot:
+
+			if verbose:
+				print('  Ignoring file: binary')
+
+			return (current_file,Counter(),0)
+
+		snapshot += snapshot_file.read()
+
+	# Split on newlines alone, as iterating over the file would. A file that
+	# ends with a newline (or is empty) leaves an empty string at the end of
+	# the split which isn't a line, so it is dropped.
+
+	filelines = snapshot.split(b'\n')
+
+	if not filelines[-1]:
+		filelines.pop()
+
+	# Only lines long enough to be matched are considered. If there are none,
+	# there is nothing to look up.
+
+	filelines = [fileline for fileline in
+		(fileline.strip() for fileline in filelines)
+		if len(fileline) >= sensitivity]
+
+	if not filelines:
 
 		if verbose:
-			print('\n  Matched lines: %s' % matched)
-			print('  Unmatched lines: %s\n' % unmatched)
+			print('  Ignoring file: no lines long enough to match')
 
-		if obnoxious:
-			print('  Writing results to %s\n' % output_csv)
+		return (current_file,Counter(),0)
 
-		with open(output_csv,'a', newline='', encoding='utf-8') as outfile:
-			csv_writer = csv.writer(outfile)
+	# Now walk through the file and look for matches in the git log
 
-			data = cursor.execute('''SELECT * from data''')
-			csv_writer.writerows(data)
+	if obnoxious:
+		print('\n   Walking through the file:')
 
-		db_conn.close()
+	matches, unmatched = match_lines(filelines,file_log_index,line_lengths)
+
+	if verbose:
+		print('\n  Matched lines: %s' % sum(matches.values()))
+		print('  Unmatched lines: %s\n' % unmatched)
+
+	return (current_file,matches,unmatched)
+
+def write_results(csv_writer,current_file,matches,unmatched):
+
+# Write one file's results to the output CSV
+
+	if obnoxious:
+		print('  Writing results to %s\n' % output_csv)
+
+	csv_writer.writerows((current_file,) + commit + (count,)
+		for commit, count in matches.items())
+
+	if unmatched:
+		csv_writer.writerow((current_file,
+			'Unmatched','Unmatched','Unmatched',
+			'Unmatched','Unmatched','Unmatched',
+			'N/A',unmatched))
 
 #### The real program starts here ####
 
@@ -372,7 +458,7 @@ if __name__ == '__main__':
 			print('Option set: verbosity increased obnoxiously (disables multithreading)')
 
 		elif opt == '-S':
-			sensitivity = arg
+			sensitivity = int(arg)
 			print('Option set: changed sensitivity to %s' % arg)
 
 		elif opt == '-i':
@@ -389,16 +475,64 @@ if __name__ == '__main__':
 
 	start_time = time.time()
 
-	# Get the total number of files we'll need to consider
+	# Gather the files we'll need to consider, skipping .git and anything on
+	# the ignored files list
+
+	snapshot_files = list()
+
+	for root, directories, filenames in os.walk(source):
+
+		# Don't descend into .git directories at all. Sorting the rest keeps
+		# the order files are handed out to be analyzed the same between runs.
+
+		if '.git' in directories:
+
+			if verbose:
+				print(' Ignoring %s: .git directory' % os.path.join(root,'.git'))
+
+			directories.remove('.git')
+
+		directories.sort()
+
+		for filename in sorted(filenames):
+
+			# If the file has an ignored extension, move on to the next file
+
+			if ignore_files and filename.endswith(ignore_files_list):
+
+				if verbose:
+					print(' Ignoring file %s: On the ignored files list' %
+						os.path.join(root,filename))
+
+				continue
+
+			snapshot_files.append(os.path.join(root,filename))
+
+	# Read the history of every file in the snapshot in one go
+
+	git_paths = [os.path.relpath(snapshot_file,source).replace(os.sep,'/')
+		for snapshot_file in snapshot_files]
+
+	if verbose:
+		print('\n Reading the history of %s' % repo)
+
+	log_index, line_lengths = read_log_index(set(git_paths))
+
+	# Each file is handed out with its own part of the index, so no process
+	# is ever sent the whole thing and each part is only sent once
+
+	tasks = ((snapshot_file,log_index.get(git_path,dict()),
+		line_lengths.get(git_path,frozenset()))
+		for snapshot_file, git_path in zip(snapshot_files,git_paths))
 
 	if verbose:
-		total_files = sum([len(files) for root, directories, files in os.walk(source)])
+		total_files = len(snapshot_files)
 
 		file_count = 1
 
-	# Write the header for the output file
+	# Open the output file once for the whole run and write the header
 
-	with open(output_csv,'w') as outfile:
+	with open(output_csv,'w', newline='', encoding='utf-8', buffering=1<<20) as outfile:
 		csv_writer = csv.writer(outfile)
 
 		outfile.write('\ufeff')
@@ -407,17 +541,27 @@ if __name__ == '__main__':
 			'Committer name','Committer email','Committer date',
 			'Commit','Number of lines'])
 
-	# Walk through all the files in the source tarball
+		# Analyze each file in the source tarball. Files are independent of
+		# each other, so they are spread across the pool in small chunks and
+		# written in whatever order they finish, so one slow file doesn't hold
+		# up the rest. The results are written here so only one process ever
+		# touches the output file.
 
-	if multithreaded:
-		pool = Pool()
+		if multithreaded:
 
-	for root, directories, filenames in os.walk(source):
+			# os.cpu_count() is None when the number of CPUs can't be determined
 
-		if multithreaded:
-			pool.apply_async(analyze_file,(root,filenames))
+			workers = os.cpu_count() or 1
+			pool = Pool(processes=workers, initializer=init_worker,
+				initargs=({'sensitivity': sensitivity, 'ignore_files': ignore_files,
+					'verbose': verbose, 'obnoxious': obnoxious},))
+			results = pool.imap_unordered(analyze_file,tasks,
+				chunksize=max(1,len(snapshot_files) // (workers * 8)))
 		else:
-			analyze_file(root,filenames)
+			results = map(analyze_file,tasks)
+
+		for result in results:
+			write_results(csv_writer,*result)
 
 	if multithreaded:
 		pool.close()